@@ -1,16 +1,35 @@
 #!/usr/bin/env python3
-import docker
 import time
+import atexit
 import logging
 import os
+import platform
+import queue
+import random
+import re
+import signal
+import threading
 import subprocess
 import requests
-from logging.handlers import RotatingFileHandler
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from dotenv import load_dotenv
 import argparse
-import json
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict, defaultdict, deque
+from functools import lru_cache
+
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
 
 # =========================
 # Environment setup
@@ -18,6 +37,13 @@ from pathlib import Path
 load_dotenv()
 HOSTNAME = os.getenv("HOST_MACHINE", "unknown-host")
 STACKS_BASE_DIR = Path(os.getenv("STACKS_BASE_DIR", "/opt/infra/stacks"))
+COMPOSE_FILES = ("docker-compose.yaml", "docker-compose.yml")
+# Merged in automatically by compose when present next to the compose file
+COMPOSE_OVERRIDE_FILES = ("docker-compose.override.yaml", "docker-compose.override.yml")
+# Everything compose reads a stack's configuration from
+STACK_CONFIG_FILES = (*COMPOSE_FILES, *COMPOSE_OVERRIDE_FILES, ".env")
+# Caps the pulls/recreates a single compose invocation runs at once
+COMPOSE_ENV = {**os.environ, "COMPOSE_PARALLEL_LIMIT": os.getenv("COMPOSE_PARALLEL_LIMIT") or "4"}
 
 # =========================
 # CLI arguments
@@ -35,9 +61,23 @@ RUN_ONCE = args.run_once
 def to_bool(value):
     return str(value).lower() in ("1", "true", "yes", "y", "on")
 
+def env_int(name, default):
+    raw = (os.getenv(name) or "").strip()
+    return int(raw) if raw.isdigit() else default
+
+def env_set(name):
+    return frozenset(v.strip() for v in os.getenv(name, "").split(",") if v.strip())
+
 CFG = {
-    "check_interval": int(os.getenv("CHECK_INTERVAL") or 86400),
-    "skip_containers": [c.strip() for c in os.getenv("SKIP_CONTAINERS", "").split(",") if c.strip()],
+    "check_interval": env_int("CHECK_INTERVAL", 86400),
+    "max_parallel_stacks": max(1, env_int("MAX_PARALLEL_STACKS", 4)),
+    "max_async": max(1, env_int("MAX_ASYNC", 16)),
+    "remote_digest_ttl": env_int("REMOTE_DIGEST_TTL", 900),
+    "event_cooldown": 300,
+    "compose_timeout": max(1, env_int("COMPOSE_TIMEOUT", 1800)),
+    "skip_containers": env_set("SKIP_CONTAINERS"),
+    "allowlist": env_set("STACKS_ALLOWLIST"),
+    "denylist": env_set("STACKS_DENYLIST"),
     "notifications": {
         "enabled": to_bool(os.getenv("TELEGRAM", "false")),
         "telegram_bot_token": os.getenv("TELEGRAM_BOT_TOKEN"),
@@ -50,6 +90,13 @@ CFG = {
     }
 }
 
+# Hot-path settings bound once
+CHECK_INTERVAL = CFG["check_interval"]
+NOTIFY_ENABLED = CFG["notifications"]["enabled"]
+TG_TOKEN = CFG["notifications"]["telegram_bot_token"]
+TG_CHAT = CFG["notifications"]["telegram_chat_id"]
+TG_URL = f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage" if TG_TOKEN else None
+
 # =========================
 # Logging setup
 # =========================
@@ -75,141 +122,851 @@ file_handler.setLevel(logging.INFO)
 fmt = logging.Formatter('%(asctime)s - %(levelname)s - [%(hostname)s] - %(message)s')
 console.setFormatter(fmt)
 file_handler.setFormatter(fmt)
-logger.addHandler(console)
-logger.addHandler(file_handler)
+
+# Callers still merge msg % args (QueueHandler.prepare); the formatter's
+# timestamp/level layout and the console and disk writes run on the listener thread
+log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, console, file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # =========================
 # Docker client
 # =========================
-client = docker.from_env()
+# Created on first use: importing the SDK and probing the socket is skipped
+# entirely in --dry-run, which never talks to the daemon.
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import docker
+                _client = docker.from_env()
+    return _client
+
+# =========================
+# HTTP session
+# =========================
+# Shared by Telegram and registry calls so TLS connections are reused across
+# the whole cycle; 429/503 retries wait for the server's Retry-After.
+# Status retries stay limited to urllib3's idempotent methods (the registry's
+# HEAD/GET): a sendMessage POST answered with a 5xx may already be delivered.
+SESSION = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+)
+SESSION.mount("https://", adapter)
+SESSION.mount("http://", adapter)  # plain-HTTP LAN registry mirrors
+# Telegram only gets connection retries; send_telegram() owns the single
+# 429 retry_after path, so one message is POSTed at most twice
+SESSION.mount("https://api.telegram.org", HTTPAdapter(max_retries=Retry(total=3, read=0, status=0, backoff_factor=0.3)))
 
 # =========================
 # Telegram notification
 # =========================
+
+# HOSTNAME never changes, so it is baked into the templates once (braces escaped for str.format)
+HOST_INFO = "\n🏠 Host: `%s`" % HOSTNAME.replace("{", "{{").replace("}", "}}")
+TEMPLATES = {
+    "dry_run": HOST_INFO + "\n🧪 *DRY RUN MODE*\n🔍 No changes will be applied.\n🕒 Time: {ts}",
+    "update": HOST_INFO + "\n🟢 *Update*\n🐳 Container: `{name}`\nNew Image: `{image}`\n🕒 Time: {ts}",
+    "up_to_date": HOST_INFO + "\n✅ *No Update Needed*\n🐳 Container: `{name}`\n🕒 Time: {ts}",
+    "error": HOST_INFO + "\n⚠️ *Error*\n🐳 Container: `{name}`\nDetails: `{extra}`\n🕒 Time: {ts}",
+    "cleanup": HOST_INFO + "\n🧹 *Cleanup*\nReclaimed space: `{extra:.2f} MB`\n🕒 Time: {ts}",
+    "info": HOST_INFO + "\nℹ️ *Info*\n{extra}\n🕒 Time: {ts}",
+}
+DEFAULT_TEMPLATE = HOST_INFO + "\nℹ️ *Notification*\n🐳 Container: `{name}`\n🕒 Time: {ts}"
+
+TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+_ts_cache = (0, "")
+
+def current_timestamp():
+    # Messages of one cycle share the same few seconds; format each second once
+    global _ts_cache
+    now = int(time.time())
+    if _ts_cache[0] != now:
+        _ts_cache = (now, time.strftime(TS_FORMAT, time.localtime(now)))
+    return _ts_cache[1]
+
+# Legacy Markdown cannot escape inside `code` spans, where dynamic values go;
+# a stray backtick (common in compose errors) would make Telegram reject the
+# message. The static template text is already valid and is left alone.
+_MD_CODE = str.maketrans("`", "'")
+_MD_TEXT = str.maketrans({c: "\\" + c for c in "_*`["})
+
+TG_MAX_LEN = 4096
+# Room left for the details once the template around them is filled in
+TG_MAX_EXTRA = 3500
+
+def md_value(value, table=_MD_CODE):
+    return value.translate(table) if isinstance(value, str) else value
+
 def format_telegram_message(event_type, container_name=None, image=None, extra=None):
-    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    host_info = f"\n🏠 Host: `{HOSTNAME}`"
-
-    if event_type == "dry_run":
-        return f"{host_info}\n🧪 *DRY RUN MODE*\n🔍 No changes will be applied.\n🕒 Time: {ts}"
-    if event_type == "update":
-        return f"{host_info}\n🟢 *Update*\n🐳 Container: `{container_name}`\nNew Image: `{image}`\n🕒 Time: {ts}"
-    if event_type == "up_to_date":
-        return f"{host_info}\n✅ *No Update Needed*\n🐳 Container: `{container_name}`\n🕒 Time: {ts}"
-    if event_type == "error":
-        return f"{host_info}\n⚠️ *Error*\n🐳 Container: `{container_name}`\nDetails: `{extra}`\n🕒 Time: {ts}"
-    if event_type == "cleanup":
-        return f"{host_info}\n🧹 *Cleanup*\nReclaimed space: `{extra:.2f} MB`\n🕒 Time: {ts}"
-    if event_type == "info":
-        return f"{host_info}\nℹ️ *Info*\n{extra}\n🕒 Time: {ts}"
-
-    return f"{host_info}\nℹ️ *Notification*\n🐳 Container: `{container_name}`\n🕒 Time: {ts}"
+    ts = current_timestamp()
+    table = _MD_TEXT if event_type == "info" else _MD_CODE
+    if isinstance(extra, str):
+        # Cut before escaping so no code span or escape is split; the tail of
+        # an error dump is the useful part. Escaping can double plain text.
+        limit = TG_MAX_EXTRA // 2 if table is _MD_TEXT else TG_MAX_EXTRA
+        if len(extra) > limit:
+            extra = "…" + extra[-limit:]
+    return TEMPLATES.get(event_type, DEFAULT_TEMPLATE).format(
+        name=md_value(container_name), image=md_value(image),
+        extra=md_value(extra, table), ts=ts
+    )
+
+TG_MIN_INTERVAL = 1.0  # Telegram allows about one message per second per chat
+_pending = []
+_pending_keys = set()
+_pending_lock = threading.Lock()
+_last_send = 0.0
 
 def notify(container_name=None, event_type="info", image=None, extra=None):
+    # One line per event; long details (compose stderr) are already logged by the caller
+    summary = "" if extra is None else str(extra).partition("\n")[0]
+    logger.info("Notification %s: %s %s", event_type, container_name, summary)
+    if not NOTIFY_ENABLED or not TG_TOKEN:
+        # Nothing is sent, so skip building the Telegram body
+        return
+
     msg = format_telegram_message(event_type, container_name, image, extra)
-    logger.info(msg)
-    if CFG["notifications"]["enabled"] and CFG["notifications"]["telegram_bot_token"]:
+    # The same event for the same stack is reported once per batch
+    key = (event_type, container_name, image, str(extra))
+    with _pending_lock:
+        if key not in _pending_keys:
+            _pending_keys.add(key)
+            _pending.append(msg)
+
+def send_telegram(text):
+    global _last_send
+    for attempt in range(2):
+        wait = _last_send + TG_MIN_INTERVAL - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
         try:
-            resp = requests.post(
-                f"https://api.telegram.org/bot{CFG['notifications']['telegram_bot_token']}/sendMessage",
+            resp = SESSION.post(
+                TG_URL,
                 data={
-                    "chat_id": CFG["notifications"]["telegram_chat_id"],
-                    "text": msg,
+                    "chat_id": TG_CHAT,
+                    "text": text,
                     "parse_mode": "Markdown"
                 },
                 timeout=10
             )
+            _last_send = time.monotonic()
+            if resp.status_code == 429 and attempt == 0:
+                # Flood control: Telegram tells us how long to back off
+                retry_after = _json.loads(resp.content).get("parameters", {}).get("retry_after", 1)
+                time.sleep(retry_after + random.uniform(0, 1))
+                continue
             if resp.status_code != 200:
-                logger.warning(f"[Telegram] Failed to send: {resp.text}")
+                logger.warning("[Telegram] Failed to send: %s", resp.text)
         except Exception as e:
-            logger.warning(f"[Telegram] Exception: {e}")
+            logger.warning("[Telegram] Exception: %s", e)
+        return
+
+def flush_notifications():
+    with _pending_lock:
+        messages = _pending[:]
+        _pending.clear()
+        _pending_keys.clear()
+
+    # Pack queued messages into as few sendMessage calls as Telegram's size limit allows
+    batch = ""
+    for msg in messages:
+        candidate = f"{batch}\n---\n{msg}" if batch else msg
+        if len(candidate) <= TG_MAX_LEN:
+            batch = candidate
+            continue
+        if batch:
+            send_telegram(batch)
+        batch = msg
+    if batch:
+        send_telegram(batch)
 
 # =========================
 # Discover stacks
 # =========================
 def discover_stacks():
-    if not STACKS_BASE_DIR.exists():
-        logger.error(f"Stacks base directory does not exist: {STACKS_BASE_DIR}")
+    # One scandir pass; cheap enough per sweep that caching it is not worth it
+    try:
+        with os.scandir(STACKS_BASE_DIR) as it:
+            return [
+                Path(entry.path) for entry in it
+                if entry.is_dir() and any(os.path.isfile(os.path.join(entry.path, f)) for f in COMPOSE_FILES)
+            ]
+    except FileNotFoundError:
+        logger.error("Stacks base directory does not exist: %s", STACKS_BASE_DIR)
         return []
 
-    stacks = []
-    for d in STACKS_BASE_DIR.iterdir():
-        if d.is_dir() and (d / "docker-compose.yaml").exists():
-            stacks.append(d)
-    return stacks
+def stack_allowed(name):
+    return (not CFG["allowlist"] or name in CFG["allowlist"]) and name not in CFG["denylist"]
+
+# =========================
+# Registry digests
+# =========================
+DOCKER_HUB_REGISTRY = "registry-1.docker.io"
+MANIFEST_ACCEPT = ", ".join([
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+])
+
+@lru_cache(maxsize=1024)
+def parse_image_ref(image_ref):
+    name, tag = image_ref, "latest"
+    if ":" in image_ref.rsplit("/", 1)[-1]:
+        name, tag = image_ref.rsplit(":", 1)
+
+    first, _, rest = name.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        registry, path = first, rest
+    else:
+        registry, path = DOCKER_HUB_REGISTRY, name
+    if registry == "docker.io":
+        registry = DOCKER_HUB_REGISTRY
+    if registry == DOCKER_HUB_REGISTRY and "/" not in path:
+        path = f"library/{path}"
+    return registry, path, tag
+
+TARGET_ARCH = os.getenv("TARGET_ARCH") or {"x86_64": "amd64", "aarch64": "arm64", "armv7l": "arm"}.get(
+    platform.machine(), platform.machine()
+)
+
+REGISTRY_MIRROR = (os.getenv("REGISTRY_MIRROR") or "").rstrip("/")
+if REGISTRY_MIRROR and "://" not in REGISTRY_MIRROR:
+    REGISTRY_MIRROR = f"https://{REGISTRY_MIRROR}"
+
+_token_cache = {}
+
+def get_registry_token(realm, service, registry, path):
+    params = {"scope": f"repository:{path}:pull"}
+    if service:
+        params["service"] = service
+    resp = SESSION.get(realm, params=params, timeout=10)
+    resp.raise_for_status()
+    data = _json.loads(resp.content)
+    token = data.get("token") or data.get("access_token")
+    ttl = min(300, int(data.get("expires_in") or 300)) - 10
+    _token_cache[(registry, path)] = (time.monotonic() + ttl, token)
+    return token
+
+def registry_request(method, registry, path, reference):
+    # Docker Hub lookups go to the local pull-through mirror when one is configured
+    mirrored = registry == DOCKER_HUB_REGISTRY and REGISTRY_MIRROR
+    base = REGISTRY_MIRROR if mirrored else f"https://{registry}"
+    url = f"{base}/v2/{path}/manifests/{reference}"
+    headers = {"Accept": MANIFEST_ACCEPT}
+
+    expires, token = _token_cache.get((registry, path), (0, None))
+    if time.monotonic() >= expires:
+        token = None
+        if registry == DOCKER_HUB_REGISTRY and not mirrored:
+            token = get_registry_token("https://auth.docker.io/token", "registry.docker.io", registry, path)
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    resp = SESSION.request(method, url, headers=headers, timeout=10)
+
+    # Other registries announce their token endpoint in the 401 challenge
+    challenge = resp.headers.get("WWW-Authenticate", "")
+    if resp.status_code == 401 and challenge.lower().startswith("bearer "):
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        token = get_registry_token(params["realm"], params.get("service"), registry, path)
+        headers["Authorization"] = f"Bearer {token}"
+        resp = SESSION.request(method, url, headers=headers, timeout=10)
+
+    resp.raise_for_status()
+    return resp
+
+_digest_cache = {}
+_digest_locks = defaultdict(threading.Lock)
+
+def get_remote_digest(image_ref):
+    cached = _digest_cache.get(image_ref)
+    if cached and time.monotonic() - cached[0] < CFG["remote_digest_ttl"]:
+        return cached[1]
+
+    # Stacks sharing an image are checked concurrently; only the first one
+    # asks the registry, the others wait and read its result from the cache.
+    with _digest_locks[image_ref]:
+        now = time.monotonic()
+        cached = _digest_cache.get(image_ref)
+        if cached and now - cached[0] < CFG["remote_digest_ttl"]:
+            return cached[1]
+
+        digest = fetch_remote_digest(image_ref)
+        if digest:
+            _digest_cache[image_ref] = (now, digest)
+        return digest
+
+def evict_remote_digests():
+    # Images that disappeared from every stack would otherwise stay cached forever
+    now = time.monotonic()
+    for image_ref, (fetched, _) in list(_digest_cache.items()):
+        if now - fetched >= CFG["remote_digest_ttl"]:
+            del _digest_cache[image_ref]
+            _digest_locks.pop(image_ref, None)
+
+def fetch_remote_digest(image_ref):
+    registry, path, tag = parse_image_ref(image_ref)
+    try:
+        return registry_request("HEAD", registry, path, tag).headers.get("Docker-Content-Digest")
+    except Exception as e:
+        logger.warning("Could not resolve remote digest for %s: %s", image_ref, e)
+        return None
+
+# Keyed by the remote manifest digest, so a cached answer can never go stale;
+# failed lookups raise and are not cached
+@lru_cache(maxsize=1024)
+def fetch_remote_config_digest(image_ref, digest):
+    # Resolves the config digest (the local image ID) of the TARGET_ARCH image
+    registry, path, _ = parse_image_ref(image_ref)
+    manifest = _json.loads(registry_request("GET", registry, path, digest).content)
+    for entry in manifest.get("manifests", []):
+        entry_platform = entry.get("platform", {})
+        if entry_platform.get("os") == "linux" and entry_platform.get("architecture") == TARGET_ARCH:
+            manifest = _json.loads(registry_request("GET", registry, path, entry["digest"]).content)
+            break
+    return manifest.get("config", {}).get("digest")
+
+_local_images = None
+_local_images_lock = threading.Lock()
+
+def get_local_image(image_ref):
+    # One image listing (Id, RepoTags, RepoDigests) answers every lookup of a
+    # sweep instead of an inspect call per image
+    global _local_images
+    with _local_images_lock:
+        if _local_images is None:
+            _local_images = {
+                parse_image_ref(tag): image
+                for image in get_client().api.images()
+                for tag in image.get("RepoTags") or []
+                if tag != "<none>:<none>"
+            }
+        return _local_images.get(parse_image_ref(image_ref))
+
+def evict_local_images():
+    global _local_images
+    with _local_images_lock:
+        _local_images = None
+
+def is_image_current(image_ref, remote):
+    local = get_local_image(image_ref)
+    if local is None:
+        return False
+    repo_digests = local.get("RepoDigests") or []
+    if remote in {rd.split("@", 1)[1] for rd in repo_digests if "@" in rd}:
+        return True
+
+    # A multi-arch index changes whenever any platform is rebuilt; only the
+    # image built for this host matters.
+    try:
+        return fetch_remote_config_digest(image_ref, remote) == local["Id"]
+    except Exception as e:
+        logger.warning("Could not resolve %s image for %s: %s", TARGET_ARCH, image_ref, e)
+        return False
+
+def kill_process_group(proc, timed_out=None):
+    if timed_out is not None:
+        timed_out.set()
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # exited just before the deadline
+
+def compose_config(stack_dir: Path, *args):
+    # Same process-group handling as compose up: a timeout must not leave the
+    # compose plugin child behind
+    with subprocess.Popen(
+        ["docker", "compose", "config", *args], cwd=stack_dir, env=COMPOSE_ENV, start_new_session=True,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    ) as proc:
+        try:
+            stdout, stderr = proc.communicate(timeout=CFG["compose_timeout"])
+        except subprocess.TimeoutExpired:
+            kill_process_group(proc)
+            proc.communicate()
+            raise
+    if proc.returncode != 0:
+        raise RuntimeError(stderr)
+    return stdout
+
+_stack_config_cache = {}
+
+def get_stack_config(stack_dir: Path):
+    # Project name, service -> image and service -> config hash; they only
+    # change when the compose file, an override or .env does
+    key = tuple(
+        os.stat(p).st_mtime_ns if os.path.exists(p) else None
+        for p in (os.path.join(stack_dir, f) for f in STACK_CONFIG_FILES)
+    )
+    cached = _stack_config_cache.get(stack_dir.name)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    config = _json.loads(compose_config(stack_dir, "--format", "json"))
+    project = config["name"]
+    # Services that are only built get compose's default <project>-<service> image name
+    services = {name: spec.get("image") or f"{project}-{name}" for name, spec in (config.get("services") or {}).items()}
+    try:
+        hashes = dict(line.split(None, 1) for line in compose_config(stack_dir, "--hash", "*").splitlines() if line.strip())
+    except RuntimeError:
+        hashes = {}  # compose without config --hash; only image IDs are compared
+    _stack_config_cache[stack_dir.name] = (key, (project, services, hashes))
+    return project, services, hashes
+
+def get_stack_images(stack_dir: Path):
+    return list(dict.fromkeys(get_stack_config(stack_dir)[1].values()))
+
+def find_stale_images(stack_dir: Path):
+    stale = set()
+    for image in get_stack_images(stack_dir):
+        if "@" in image:
+            continue  # pinned by digest, never changes
+        remote = get_remote_digest(image)
+        # An unknown remote digest falls back to a regular compose pull
+        if remote is None:
+            return None
+        if not is_image_current(image, remote):
+            stale.add(image)
+    return stale
+
+def stack_drifted(stack_dir: Path):
+    # Current images alone do not mean current containers: a failed recreate,
+    # an .env or override edit, or a new service all leave the stack behind
+    project, services, hashes = get_stack_config(stack_dir)
+    containers = get_client().api.containers(all=True, filters={"label": f"com.docker.compose.project={project}"})
+    deployed = set()
+    for container in containers:
+        labels = container.get("Labels") or {}
+        service = labels.get("com.docker.compose.service")
+        if service not in services or labels.get("com.docker.compose.oneoff") == "True":
+            continue
+        deployed.add(service)
+        expected = hashes.get(service)
+        if expected and labels.get("com.docker.compose.config-hash") != expected:
+            return True
+        image = services[service]
+        local = None if "@" in image else get_local_image(image)
+        if local is not None and container.get("ImageID") != local["Id"]:
+            return True
+    return deployed != services.keys()
+
+# References we are pulling ourselves; their pull events are not external pulls
+own_pulls = set()
+
+def pull_images(images):
+    if not images:
+        return set()
+    from docker.utils import parse_repository_tag
+
+    def pull(image):
+        repo, tag = parse_repository_tag(image)
+        ref = parse_image_ref(image)
+        own_pulls.add(ref)
+        try:
+            # Pull failures are reported inside the progress stream, not as HTTP errors
+            for line in get_client().api.pull(repo, tag=tag or "latest", stream=True, decode=True):
+                if "error" in line:
+                    raise RuntimeError(line["error"])
+            return True
+        except Exception as e:
+            # A failed pull may emit no event to consume the entry
+            own_pulls.discard(ref)
+            logger.warning("Could not pull %s: %s", image, e)
+            return False
+
+    with ThreadPoolExecutor(max_workers=CFG["max_parallel_stacks"]) as ex:
+        pulled = {image for image, ok in zip(images, ex.map(pull, images)) if ok}
+    evict_local_images()
+    return pulled
 
 # =========================
 # Update stack function
 # =========================
-def update_stack(stack_dir: Path):
+last_update = OrderedDict()
+_last_update_lock = threading.Lock()
+LAST_UPDATE_MAX = 4096
+
+def mark_updated(stack_name):
+    # Monotonic so clock adjustments cannot skip or repeat the event cooldown;
+    # bounded so removed stacks do not accumulate in a long-lived process.
+    with _last_update_lock:
+        last_update[stack_name] = time.monotonic()
+        last_update.move_to_end(stack_name)
+        if len(last_update) > LAST_UPDATE_MAX:
+            last_update.popitem(last=False)
+
+# Stacks whose last compose up failed are redeployed on the next check
+failed_stacks = set()
+
+def check_stack(stack_dir: Path):
+    stack_name = stack_dir.name
+    logger.info("Checking stack: %s", stack_name)
+    if DRY_RUN:
+        return True, None
+    if stack_name in failed_stacks:
+        logger.info("Last update of stack %s failed; retrying.", stack_name)
+        return True, None
+
+    try:
+        stale = find_stale_images(stack_dir)
+    except Exception as e:
+        logger.warning("Digest check failed for stack %s: %s", stack_name, e)
+        return True, None
+    if stale is None or stale:
+        return True, stale
+
+    try:
+        drifted = stack_drifted(stack_dir)
+    except Exception as e:
+        logger.warning("Container check failed for stack %s: %s", stack_name, e)
+        drifted = True
+    if drifted:
+        # Every image is already local, compose only has to recreate
+        logger.info("Stack %s is not running its current images or configuration.", stack_name)
+        return True, set()
+
+    logger.info("Stack %s is up to date.", stack_name)
+    notify(stack_name, "up_to_date")
+    return False, stale
+
+COMPOSE_ERROR_LINES = 50
+
+def update_stack(stack_dir: Path, pulled=False):
     stack_name = stack_dir.name
-    logger.info(f"Checking stack: {stack_name}")
 
     if DRY_RUN:
-        logger.info(f"[DRY-RUN] Would pull and update stack {stack_name}")
+        logger.info("[DRY-RUN] Would pull and update stack %s", stack_name)
         notify(stack_name, "dry_run")
-        return
+        mark_updated(stack_name)
+        return False
 
     try:
-        # Pull images
-        pull_cmd = ["docker", "compose", "pull"]
-        result = subprocess.run(pull_cmd, cwd=stack_dir, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise RuntimeError(result.stderr)
-        logger.info(result.stdout)
-
-        # Up containers
-        up_cmd = ["docker", "compose", "up", "-d", "--no-deps"]
-        result = subprocess.run(up_cmd, cwd=stack_dir, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise RuntimeError(result.stderr)
-        logger.info(result.stdout)
+        # Pull images (unless already done for the whole sweep) and recreate
+        # changed containers in one compose invocation
+        pull_policy = "--pull=never" if pulled else "--pull=always"
+        up_cmd = ["docker", "compose", "up", "-d", pull_policy, "--no-deps"]
+        # Compose reports progress on stderr; it is logged line by line as
+        # it arrives instead of being buffered until the command exits
+        # Own session so a timeout can kill the whole group: the compose
+        # plugin child would otherwise keep stderr open after the CLI dies
+        with subprocess.Popen(
+            up_cmd, cwd=stack_dir, env=COMPOSE_ENV, start_new_session=True,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        ) as proc:
+            # A hung pull or recreate is killed rather than holding a pool
+            # worker (and its compose client) forever
+            timed_out = threading.Event()
+            watchdog = threading.Timer(CFG["compose_timeout"], kill_process_group, args=(proc, timed_out))
+            watchdog.daemon = True
+            watchdog.start()
+            # Only the tail is kept for the error report, however verbose the pull
+            output = deque(maxlen=COMPOSE_ERROR_LINES)
+            try:
+                for line in proc.stderr:
+                    line = line.rstrip()
+                    logger.info("[%s] %s", stack_name, line)
+                    output.append(line)
+            finally:
+                watchdog.cancel()
+        if timed_out.is_set():
+            raise subprocess.TimeoutExpired(up_cmd, CFG["compose_timeout"], stderr="\n".join(output))
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, up_cmd, stderr="\n".join(output))
 
+        failed_stacks.discard(stack_name)
         notify(stack_name, "update", extra=f"Stack updated successfully: {stack_name}")
+        return True
 
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        # Exit status or timeout first, then the compose stderr tail
+        details = f"{e}\n{e.stderr}" if e.stderr else str(e)
+        logger.error("Error updating stack %s: %s", stack_name, details)
+        notify(stack_name, "error", extra=details)
+        failed_stacks.add(stack_name)
+        return False
     except Exception as e:
-        logger.error(f"Error updating stack {stack_name}: {e}")
+        logger.error("Error updating stack %s: %s", stack_name, e)
         notify(stack_name, "error", extra=str(e))
+        failed_stacks.add(stack_name)
+        return False
+    finally:
+        mark_updated(stack_name)
+
+def apply_updates(outdated):
+    # Stale images are pulled exactly once, even when several stacks share
+    # them; compose then only recreates. Stacks whose stale set is unknown
+    # (None) or failed to pull let compose pull everything itself.
+    pulled = pull_images(sorted(set().union(*(i for i in outdated.values() if i))))
+
+    updated = False
+    with ThreadPoolExecutor(max_workers=CFG["max_parallel_stacks"]) as ex:
+        futures = {
+            ex.submit(update_stack, s, images is not None and images <= pulled): s
+            for s, images in outdated.items()
+        }
+        for f in as_completed(futures):
+            try:
+                updated |= f.result()
+            except Exception as e:
+                logger.error("Unhandled error in stack %s: %s", futures[f].name, e)
+                notify(futures[f].name, "error", extra=str(e))
+    return updated
 
 # =========================
 # Cleanup unused images
 # =========================
 def cleanup_unused_images():
     try:
+        # Listing dangling IDs is far cheaper than a prune walk over the whole image store
+        if not get_client().api.images(quiet=True, filters={"dangling": True}):
+            logger.info("🧹 No dangling images to prune.")
+            return
         logger.info("🧹 Pruning unused images…")
-        unused = client.images.prune(filters={"dangling": True})
+        unused = get_client().images.prune(filters={"dangling": True})
         reclaimed = unused.get("SpaceReclaimed", 0)
         if reclaimed > 0:
             size_mb = reclaimed / (1024 * 1024)
-            logger.info(f"Reclaimed {size_mb:.2f} MB from unused images.")
+            logger.info("Reclaimed %.2f MB from unused images.", size_mb)
             notify("Docker Images", "cleanup", extra=size_mb)
     except Exception as e:
-        logger.error(f"Failed pruning images: {e}")
+        logger.error("Failed pruning images: %s", e)
         notify("Docker Images", "error", extra=str(e))
 
+# =========================
+# Docker events
+# =========================
+triggers = queue.Queue()
+stop_requested = threading.Event()
+
+def wake_main_loop():
+    # Queue.put takes a lock the interrupted main thread may be holding, so a
+    # signal handler must not call it directly.
+    threading.Thread(target=triggers.put, args=(None,), daemon=True).start()
+
+def handle_sigterm(signum, frame):
+    logger.info("Received SIGTERM; stopping after the current step.")
+    stop_requested.set()
+    wake_main_loop()
+
+def handle_sighup(signum, frame):
+    logger.info("Received SIGHUP; starting a full sweep now.")
+    wake_main_loop()
+
+EVENT_RETRY_MAX = 60
+
+def watch_docker_events(filters, handle):
+    delay = 1
+    while True:
+        try:
+            for evt in get_client().events(decode=True, filters=filters):
+                delay = 1
+                handle(evt.get("Actor", {}))
+            logger.warning("Docker event stream closed by the daemon.")
+        except Exception as e:
+            logger.warning("Docker event stream interrupted: %s", e)
+        # Reconnect quickly after a blip, back off while the daemon stays down;
+        # jitter keeps the watchers from reconnecting in lockstep
+        time.sleep(delay + random.uniform(0, 1))
+        delay = min(delay * 2, EVENT_RETRY_MAX)
+
+def on_container_start(actor):
+    # Containers started outside of a sweep (new deploys, manual restarts) get
+    # their stack checked right away instead of waiting for the next sweep.
+    attrs = actor.get("Attributes", {})
+    if attrs.get("name") in CFG["skip_containers"] or attrs.get("auto-update") == "false":
+        return
+    workdir = attrs.get("com.docker.compose.project.working_dir")
+    if workdir:
+        triggers.put((Path(workdir).name, "start"))
+
+def on_image_pull(actor):
+    # An image pulled by hand is newer than the containers still running it;
+    # the stacks using it only need recreating, no registry check.
+    evict_local_images()
+    pulled = parse_image_ref(actor.get("ID", ""))
+    if pulled in own_pulls:
+        own_pulls.discard(pulled)
+        return
+    for stack_name, (_, (_, services, _)) in list(_stack_config_cache.items()):
+        if any(parse_image_ref(image) == pulled for image in services.values() if "@" not in image):
+            triggers.put((stack_name, "pull"))
+
+def watch_compose_files():
+    # Editing a compose file, override or .env redeploys its stack right away; inotify is not
+    # recursive, so every stack directory gets its own watch.
+    stack_flags = flags.CLOSE_WRITE | flags.MOVED_TO
+    try:
+        ino = INotify()
+        watches = {ino.add_watch(STACKS_BASE_DIR, flags.CREATE | flags.MOVED_TO): None}
+        with os.scandir(STACKS_BASE_DIR) as it:
+            for entry in it:
+                if entry.is_dir():
+                    watches[ino.add_watch(entry.path, stack_flags)] = entry.name
+    except OSError as e:
+        logger.warning("Cannot watch %s for compose file changes: %s", STACKS_BASE_DIR, e)
+        return
+
+    while True:
+        changed = set()
+        # read_delay coalesces the burst of events an editor produces on save
+        for event in ino.read(read_delay=1000):
+            stack_name = watches.get(event.wd)
+            if stack_name is None:
+                if event.mask & flags.ISDIR:
+                    try:
+                        wd = ino.add_watch(os.path.join(STACKS_BASE_DIR, event.name), stack_flags)
+                        watches[wd] = event.name
+                    except OSError:
+                        pass
+            elif event.name in STACK_CONFIG_FILES:
+                changed.add(stack_name)
+
+        for stack_name in changed:
+            triggers.put((stack_name, "compose"))
+
+# A compose edit forces a redeploy, a pull a recreate, a start only a check
+TRIGGER_PRIORITY = {"start": 0, "pull": 1, "compose": 2}
+
+def wait_for_events(deadline):
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        try:
+            batch = [triggers.get(timeout=remaining)]
+        except queue.Empty:
+            return
+        # Triggers that piled up meanwhile (several containers of one stack
+        # starting, repeated saves) are handled once per stack, strongest reason first
+        while True:
+            try:
+                batch.append(triggers.get_nowait())
+            except queue.Empty:
+                break
+        pending = {}
+        for item in batch:
+            if item is not None:
+                stack_name, reason = item
+                if TRIGGER_PRIORITY[reason] > TRIGGER_PRIORITY.get(pending.get(stack_name), -1):
+                    pending[stack_name] = reason
+        for stack_name, reason in pending.items():
+            if stop_requested.is_set():
+                return
+            handle_trigger(stack_name, reason)
+        if None in batch:
+            return  # SIGHUP or SIGTERM
+
+def handle_trigger(stack_name, reason):
+    # Our own recreates echo back as container starts; pulls are filtered at
+    # the source and config edits always apply
+    last = last_update.get(stack_name)
+    if reason == "start" and last is not None and time.monotonic() - last < CFG["event_cooldown"]:
+        return
+    stack_dir = next((s for s in discover_stacks() if s.name == stack_name), None)
+    if stack_dir is None or not stack_allowed(stack_name):
+        return
+
+    if reason == "compose":
+        # New configuration must be applied even when every image is current
+        logger.info("Compose configuration of stack %s changed; redeploying it now.", stack_name)
+        needed, images = True, None
+    elif reason == "pull":
+        # compose up --pull=always pulls outside pull_images(); a stack that
+        # already runs the pulled image is left alone
+        try:
+            needed = stack_drifted(stack_dir)
+        except Exception as e:
+            logger.warning("Container check failed for stack %s: %s", stack_name, e)
+            needed = True
+        if needed:
+            logger.info("An image of stack %s was pulled; recreating it now.", stack_name)
+        images = set()
+    else:
+        logger.info("Container started in stack %s; checking it now.", stack_name)
+        needed, images = check_stack(stack_dir)
+    if needed and apply_updates({stack_dir: images}):
+        cleanup_unused_images()
+    flush_notifications()
+
 # =========================
 # Main loop
 # =========================
 def main():
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    signal.signal(signal.SIGHUP, handle_sighup)
+    if not RUN_ONCE:
+        if not DRY_RUN:
+            # The daemon drops non-compose containers before they reach us
+            container_filters = {"type": "container", "event": "start", "label": "com.docker.compose.project"}
+            image_filters = {"type": "image", "event": "pull"}
+            for name, filters, handle in (
+                ("container-events", container_filters, on_container_start),
+                ("image-events", image_filters, on_image_pull),
+            ):
+                threading.Thread(target=watch_docker_events, args=(filters, handle), name=name, daemon=True).start()
+        if INotify is not None:
+            threading.Thread(target=watch_compose_files, name="compose-watch", daemon=True).start()
+        else:
+            logger.info("inotify_simple not installed; compose, override and .env edits are applied on the next sweep.")
+
     try:
-        while True:
-            stacks = discover_stacks()
+        while not stop_requested.is_set():
+            # Sweeps start every CHECK_INTERVAL seconds regardless of how long one takes
+            next_sweep = time.monotonic() + CHECK_INTERVAL
+            stacks = [s for s in discover_stacks() if stack_allowed(s.name)]
             if not stacks:
                 logger.warning("No stacks found to update.")
-            for stack_dir in stacks:
-                update_stack(stack_dir)
+            evict_remote_digests()
+            evict_local_images()
+
+            # Registry lookups are cheap and independent, check every stack at once
+            if CFG["max_async"] == 1:
+                checks = list(map(check_stack, stacks))
+            else:
+                with ThreadPoolExecutor(max_workers=CFG["max_async"]) as ex:
+                    checks = list(ex.map(check_stack, stacks))
+            outdated = {s: images for s, (needed, images) in zip(stacks, checks) if needed}
 
-            cleanup_unused_images()
+            updated = apply_updates(outdated)
+
+            # Only pulls leave dangling images behind
+            if updated:
+                cleanup_unused_images()
+            flush_notifications()
 
             if RUN_ONCE:
                 logger.info("Run-once mode: exiting after single cycle.")
                 return
+            if stop_requested.is_set():
+                break
 
-            logger.info(f"💤 Sleeping {CFG['check_interval']} seconds…")
-            time.sleep(CFG["check_interval"])
+            logger.info(
+                "💤 Next full sweep in %d seconds, watching Docker events…",
+                max(0, next_sweep - time.monotonic())
+            )
+            wait_for_events(next_sweep)
 
+        logger.info("Exiting Docker auto-update script.")
     except KeyboardInterrupt:
         logger.info("Exiting Docker auto-update script.")
+    finally:
+        flush_notifications()
 
 if __name__ == "__main__":
     main()